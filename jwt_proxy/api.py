@@ -1,93 +1,342 @@
-from flask import Blueprint, abort, current_app, jsonify, request, json as flask_json
+from cachetools import TLRUCache
+from flask import Blueprint, Response, abort, current_app, jsonify, request, json as flask_json
+import hashlib
+from http.cookiejar import DefaultCookiePolicy
 import jwt
+import orjson
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import re
+import threading
+import time
 
 from jwt_proxy.audit import audit_HAPI_change
 
 blueprint = Blueprint('auth', __name__)
 SUPPORTED_METHODS = ('GET', 'POST', 'PUT', 'DELETE', 'OPTIONS')
 
+# config keys containing any of these are not exposed, e.g. secret key
+SETTINGS_BLACKLIST = ("SECRET", "KEY")
+_SETTINGS_BLACKLIST_RE = re.compile("|".join(map(re.escape, SETTINGS_BLACKLIST)))
+
+
+class CustomJSONEncoder(flask_json.JSONEncoder):
+    """orjson backed encoder, for use as the application json_encoder"""
+
+    # encoders for types orjson can't serialize natively, by exact type
+    type_encoders = {
+        set: sorted,
+        frozenset: sorted,
+    }
+
+    def default(self, obj):
+        encoder = self.type_encoders.get(type(obj))
+        if encoder is not None:
+            return encoder(obj)
+        # workaround no JSON representation for datetime.timedelta
+        return str(obj)
+
+    def encode(self, obj):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.indent:
+            option |= orjson.OPT_INDENT_2
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+
+# PyJWKClient instances keyed by JWKS URL; reused so the client's JWK set and
+# signing key caches survive across requests
+_JWKS_CLIENTS = {}
+_JWKS_CLIENTS_LOCK = threading.Lock()
+# seconds between evictions of a JWKS url's client after signature failures
+JWKS_EVICT_INTERVAL = 60
+# monotonic time of last eviction, keyed by JWKS URL
+_JWKS_EVICTED_AT = {}
+
+
+def _get_jwks_client(url):
+    """Return the shared PyJWKClient for the given JWKS url"""
+    jwks_client = _JWKS_CLIENTS.get(url)
+    if jwks_client is None:
+        with _JWKS_CLIENTS_LOCK:
+            jwks_client = _JWKS_CLIENTS.get(url)
+            if jwks_client is None:
+                jwks_client = jwt.PyJWKClient(
+                    url,
+                    cache_jwk_set=True,
+                    lifespan=300,
+                    cache_keys=True,
+                    max_cached_keys=16,
+                )
+                _JWKS_CLIENTS[url] = jwks_client
+    return jwks_client
+
+
+def _evict_jwks_client(url):
+    """Drop the cached PyJWKClient for url, at most once per JWKS_EVICT_INTERVAL
+
+    Bad signatures are attacker controlled; throttling keeps them from forcing
+    a JWKS fetch per request and emptying the key cache for everyone.
+    Returns True if the client was evicted
+    """
+    now = time.monotonic()
+    with _JWKS_CLIENTS_LOCK:
+        evicted_at = _JWKS_EVICTED_AT.get(url)
+        if evicted_at is not None and now - evicted_at < JWKS_EVICT_INTERVAL:
+            return False
+        _JWKS_EVICTED_AT[url] = now
+        _JWKS_CLIENTS.pop(url, None)
+        return True
+
+
+def _clear_jwks_cache():
+    """Drop all cached PyJWKClient instances, e.g. between tests"""
+    with _JWKS_CLIENTS_LOCK:
+        _JWKS_CLIENTS.clear()
+        _JWKS_EVICTED_AT.clear()
+
+
+# pooled session, reusing upstream connections (keep-alive) across requests.
+# Shared across worker threads: urllib3's connection pool is thread-safe, and
+# nothing per request is stored on the session (headers, params and timeout
+# are passed per call; cookies are disabled below)
+_UPSTREAM_SESSION = requests.Session()
+# shared by all users; never store upstream cookies, only forward each
+# client's own Cookie header
+_UPSTREAM_SESSION.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+_UPSTREAM_SESSION.mount(
+    "http://", HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0))
+_UPSTREAM_SESSION.mount(
+    "https://", HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0))
+
+# hop-by-hop headers (RFC 7230 section 6.1); never passed on in either direction
+HOP_BY_HOP_HEADERS = frozenset((
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+))
+# request headers not to forward upstream; requests sets its own
+EXCLUDED_HEADERS = HOP_BY_HOP_HEADERS | {"content-length", "host"}
+# upstream response headers not to pass through; body is re-chunked and decoded
+EXCLUDED_RESPONSE_HEADERS = HOP_BY_HOP_HEADERS | {"content-encoding", "content-length"}
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+JWT_ALGORITHMS = ("RS256",)
+JWT_AUDIENCE = "account"
+# longest token accepted; larger ones are rejected before hashing or crypto
+MAX_JWT_LEN = 8192
+TOKEN_CACHE_TTL = 60
+
+
+def _token_ttu(token_digest, claims, now):
+    """Expire cached claims after TOKEN_CACHE_TTL or at token `exp`, whichever is first"""
+    expires_at = now + TOKEN_CACHE_TTL
+    exp = claims.get("exp")
+    if exp is not None:
+        expires_at = min(expires_at, exp)
+    return expires_at
+
+
+# decoded claims keyed by SHA-256 of the raw token, so bearer tokens are not
+# retained in memory; skips JWKS lookup and signature verification for
+# tokens seen within the TTL
+_TOKEN_CACHE = TLRUCache(maxsize=10000, ttu=_token_ttu, timer=time.time)
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+
+def _decode_cached(token, jwks_url):
+    """Verify and decode given token, reusing recent results"""
+    token_digest = hashlib.sha256(token.encode("utf-8")).digest()
+    with _TOKEN_CACHE_LOCK:
+        decoded_token = _TOKEN_CACHE.get(token_digest)
+    if decoded_token is not None:
+        return decoded_token
+
+    jwks_client = _get_jwks_client(jwks_url)
+    signing_key = jwks_client.get_signing_key_from_jwt(token)
+    try:
+        decoded_token = jwt.decode(
+            jwt=token,
+            key=signing_key.key,
+            algorithms=JWT_ALGORITHMS,
+            audience=JWT_AUDIENCE,
+        )
+    except jwt.exceptions.InvalidSignatureError:
+        # signing keys may have rotated; refetch the key set on next use
+        _evict_jwks_client(jwks_url)
+        raise
+
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[token_digest] = decoded_token
+    return decoded_token
+
+
+def is_json_response(response):
+    """Determine from Content-Type if upstream response is JSON, e.g. application/fhir+json"""
+    mimetype = response.headers.get("Content-Type", "").partition(";")[0].strip().lower()
+    return mimetype == "application/json" or mimetype.endswith("+json")
+
+
+def stream_response(response):
+    """Pass upstream response body and content type through, without parsing"""
+    headers = [
+        (k, v) for k, v in response.headers.items()
+        if k.lower() not in EXCLUDED_RESPONSE_HEADERS]
+    streamed = Response(
+        response.iter_content(chunk_size=STREAM_CHUNK_SIZE),
+        status=response.status_code,
+        headers=headers,
+    )
+    streamed.call_on_close(response.close)
+    return streamed
+
+
+# seconds clients may reuse smart-configuration before revalidating
+SMART_CONFIGURATION_MAX_AGE = 3600
+
+# constant error bodies, serialized once
+TOKEN_MISSING = orjson.dumps({"message": "token missing"}) + b"\n"
+TOKEN_EXPIRED = orjson.dumps({"message": "token expired"}) + b"\n"
+TOKEN_TOO_LARGE = orjson.dumps({"message": "token too large"}) + b"\n"
+
+
+def error_response(body, status):
+    """Fresh response for prebuilt JSON body; responses are mutable, never share them"""
+    return current_app.response_class(body, status=status, mimetype="application/json")
+
+
+# token claims identifying the user in audit entries, in order of preference
+USER_CLAIMS = ("email", "preferred_username")
+
+
+def _extract_user_from_claims(claims):
+    """Return first populated user identifying claim, if any"""
+    for claim in USER_CLAIMS:
+        value = claims.get(claim)
+        if value:
+            return value
+    return None
+
+
+def upstream_url_for(relative_path):
+    """Upstream url for given path, joined with exactly one slash"""
+    upstream_server = current_app.config["UPSTREAM_SERVER"] or ""
+    return f"{upstream_server.rstrip('/')}/{relative_path}"
+
 
 def proxy_request(req, upstream_url, user_info=None):
     """Forward request to given url"""
-    response = requests.request(
-        method=req.method,
-        url=upstream_url,
-        headers=req.headers,
-        params=req.args,
-        json=req.json,
-        data=req.data,
-    )
+    headers = {
+        k: v for k, v in req.headers.items() if k.lower() not in EXCLUDED_HEADERS}
+    # body is streamed back as it arrives, never held in memory whole
     try:
-        result = response.json()
-    except json.decoder.JSONDecodeError:
-        return response.text
+        response = _UPSTREAM_SESSION.request(
+            method=req.method,
+            url=upstream_url,
+            headers=headers,
+            params=req.args,
+            data=req.data,
+            stream=True,
+            # threaded workers don't time out a stalled request; bound it here
+            timeout=(
+                current_app.config["UPSTREAM_CONNECT_TIMEOUT"],
+                current_app.config["UPSTREAM_READ_TIMEOUT"],
+            ),
+        )
+    except requests.exceptions.Timeout:
+        abort(504, "Upstream server timed out")
 
-    # Capture all changes
+    # Capture all changes the upstream answered with JSON
     try:
-        if req.method in ("POST", "PUT", "DELETE"):
+        if req.method in ("POST", "PUT", "DELETE") and is_json_response(response):
+            # only enqueues; entries are posted by the audit queue listener
             audit_HAPI_change(
                 user_info=user_info,
                 method=req.method,
                 params=req.args,
                 url=upstream_url,
             )
-    except Exception as e:
-        from flask import current_app
-        current_app.logger.exception(e)
-    return result
+    except Exception:
+        current_app.logger.exception("audit_HAPI_change failed")
+
+    return stream_response(response)
 
 
 @blueprint.route("/", defaults={"relative_path": ""}, methods=SUPPORTED_METHODS)
 @blueprint.route("/<path:relative_path>", methods=SUPPORTED_METHODS)
 def validate_jwt(relative_path):
     """Validate JWT and pass to upstream server"""
-    if f"/{relative_path}" in current_app.config["PATH_WHITELIST"]:
-        response_content = proxy_request(
-            req=request,
-            upstream_url=f"{current_app.config['UPSTREAM_SERVER']}/{relative_path}",
-        )
+    config = current_app.config
+    upstream_url = upstream_url_for(relative_path)
+    if f"/{relative_path}" in config["PATH_WHITELIST"]:
+        response_content = proxy_request(req=request, upstream_url=upstream_url)
         return response_content
 
-    token = request.headers.get("authorization", "").split("Bearer ")[-1]
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer":
+        token = ""
+    token = token.strip()
     if not token:
-        return jsonify(message="token missing"), 400
-
-    jwks_client = jwt.PyJWKClient(current_app.config["JWKS_URL"])
-    signing_key = jwks_client.get_signing_key_from_jwt(token)
+        return error_response(TOKEN_MISSING, 400)
+    if len(token) > MAX_JWT_LEN:
+        return error_response(TOKEN_TOO_LARGE, 400)
 
     try:
-        decoded_token = jwt.decode(
-            jwt=token,
-            # TODO cache public key in redis
-            key=signing_key.key,
-            algorithms=("RS256"),
-            audience=("account"),
-        )
+        decoded_token = _decode_cached(token, config["JWKS_URL"])
     except jwt.exceptions.ExpiredSignatureError:
-        return jsonify(message="token expired"), 401
+        return error_response(TOKEN_EXPIRED, 401)
 
     response_content = proxy_request(
         req=request,
-        upstream_url=f"{current_app.config['UPSTREAM_SERVER']}/{relative_path}",
-        user_info=decoded_token.get("email") or decoded_token.get("preferred_username"),
+        upstream_url=upstream_url,
+        user_info=_extract_user_from_claims(decoded_token),
     )
     return response_content
 
 
+def cached_json_response(name, build, max_age=None):
+    """Serve JSON body built once per app by `build`, honoring If-None-Match
+
+    Only for responses derived from configuration, which is read-only once
+    the app is serving requests
+    """
+    cache = current_app.extensions.setdefault("jwt_proxy_responses", {})
+    cached = cache.get(name)
+    if cached is None:
+        body = flask_json.dumps(build()).encode("utf-8") + b"\n"
+        cached = cache[name] = (body, hashlib.sha1(body).hexdigest())
+
+    body, etag = cached
+    response = current_app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    if max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
 @blueprint.route("/fhir/.well-known/smart-configuration")
 def smart_configuration():
     """Non-secret application settings"""
 
-    results = {
-        "authorization_endpoint": current_app.config.get("OIDC_AUTHORIZE_URL"),
-        "token_endpoint": current_app.config.get("OIDC_TOKEN_URI"),
-        "introspection_endpoint": current_app.config.get(
-            "OIDC_TOKEN_INTROSPECTION_URI"
-        ),
-    }
-    return jsonify(results)
+    def build():
+        return {
+            "authorization_endpoint": current_app.config.get("OIDC_AUTHORIZE_URL"),
+            "token_endpoint": current_app.config.get("OIDC_TOKEN_URI"),
+            "introspection_endpoint": current_app.config.get(
+                "OIDC_TOKEN_INTROSPECTION_URI"
+            ),
+        }
+
+    return cached_json_response(
+        "smart_configuration", build, max_age=SMART_CONFIGURATION_MAX_AGE)
 
 
 @blueprint.route("/settings", defaults={"config_key": None})
@@ -95,28 +344,19 @@ def smart_configuration():
 def config_settings(config_key):
     """Non-secret application settings"""
 
-    # workaround no JSON representation for datetime.timedelta
-    class CustomJSONEncoder(flask_json.JSONEncoder):
-        def default(self, obj):
-            return str(obj)
-
-    current_app.json_encoder = CustomJSONEncoder
-
     # return selective keys - not all can be be viewed by users, e.g.secret key
-    blacklist = ("SECRET", "KEY")
-
     if config_key:
         key = config_key.upper()
-        for pattern in blacklist:
-            if pattern in key:
-                abort(400, f"Configuration key {key} not available")
+        if _SETTINGS_BLACKLIST_RE.search(key):
+            abort(400, f"Configuration key {key} not available")
         return jsonify({key: current_app.config.get(key)})
 
-    results = {}
-    for key in current_app.config:
-        matches = any(pattern for pattern in blacklist if pattern in key)
-        if matches:
-            continue
-        results[key] = current_app.config.get(key)
+    def build():
+        results = {}
+        for key, value in current_app.config.items():
+            if _SETTINGS_BLACKLIST_RE.search(key):
+                continue
+            results[key] = value
+        return results
 
-    return jsonify(results)
+    return cached_json_response("settings", build)
@@ -24,12 +24,20 @@ def configure_app(app):
     """Load successive configs - overriding defaults"""
 
     app.config.from_object("jwt_proxy.config")
+    app.json_encoder = api.CustomJSONEncoder
     configure_logging(app)
 
 
+_LOGGING_CONFIGURED = False
+
+
 def configure_logging(app):
+    global _LOGGING_CONFIGURED
     app.logger  # must call to init prior to config or it'll replace
-    logging_config.fileConfig("logging.ini", disable_existing_loggers=False)
+    if not _LOGGING_CONFIGURED:
+        # process wide; only parse logging.ini for the first app created
+        logging_config.fileConfig("logging.ini", disable_existing_loggers=False)
+        _LOGGING_CONFIGURED = True
     app.logger.setLevel(getattr(logging, app.config["LOG_LEVEL"].upper()))
     if app.config["LOGSERVER_URL"] and app.config["LOGSERVER_TOKEN"]:
         audit_log_init(app)
@@ -2,37 +2,109 @@
 
 functions to simplify adding context and extra data to log messages destined for audit logs
 """
-from flask import current_app, has_app_context
+import atexit
 import logging
-from urllib.parse import urlparse
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import time
 
 from jwt_proxy.logserverhandler import LogServerHandler
 
 EVENT_LOG_NAME = "jwt_proxy_event_logger"
 EVENT_VERSION = "1"
+LOG_LEVELS = {
+    "critical": logging.CRITICAL,
+    "fatal": logging.FATAL,
+    "error": logging.ERROR,
+    "warning": logging.WARNING,
+    "warn": logging.WARNING,
+    "info": logging.INFO,
+    "debug": logging.DEBUG,
+}
+
+AUDIT_QUEUE_SIZE = 10000
+# seconds to spend posting queued entries at exit; any left are lost
+AUDIT_DRAIN_TIMEOUT = 10
+
+event_logger = logging.getLogger(EVENT_LOG_NAME)
+
+
+class DropOldestQueueHandler(QueueHandler):
+    """QueueHandler for a bounded queue, discarding the oldest entry when full
+
+    Keeps a slow or unavailable log server from growing memory without limit;
+    `dropped` counts discarded entries
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    continue
+                with self.lock:
+                    self.dropped += 1
+                    dropped = self.dropped
+                if dropped == 1 or dropped % 1000 == 0:
+                    logging.getLogger("root").warning(
+                        "audit queue full; %d entries dropped", dropped)
+
+
+class AuditQueueListener(QueueListener):
+    """QueueListener whose stop waits a bounded time for a bounded queue to drain"""
+
+    def stop(self, timeout=None):
+        """Post entries enqueued before stop, for at most timeout seconds
+
+        Entries still queued after timeout are lost; the listener thread is a
+        daemon and won't hold up interpreter exit
+        """
+        if self._thread is None:
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            self.queue.put(self._sentinel, timeout=timeout)
+        except queue.Full:
+            pass
+        else:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            self._thread.join(remaining)
+        self._thread = None
 
 
 def audit_log_init(app):
     log_server_handler = LogServerHandler(
         jwt=app.config["LOGSERVER_TOKEN"], url=app.config["LOGSERVER_URL"]
     )
-    event_logger = logging.getLogger(EVENT_LOG_NAME)
+    # entries are posted to the log server from a listener thread, so
+    # logging calls only pay for an enqueue
+    log_queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+    listener = AuditQueueListener(log_queue, log_server_handler)
+    listener.start()
+    atexit.register(listener.stop, AUDIT_DRAIN_TIMEOUT)
     event_logger.setLevel(logging.INFO)
-    event_logger.addHandler(log_server_handler)
+    event_logger.addHandler(DropOldestQueueHandler(log_queue))
 
 
 def audit_entry(message, level="info", extra=None):
     """Log entry, adding in session info such as active user"""
-    try:
-        logger = logging.getLogger(EVENT_LOG_NAME)
-        log_at_level = getattr(logger, level.lower())
-    except AttributeError:
+    # only level names; numeric levels such as logging.INFO are rejected too
+    log_level = LOG_LEVELS.get(level.lower()) if isinstance(level, str) else None
+    if log_level is None:
         raise ValueError(f"audit_entry given bogus level: {level}")
 
     if extra is None:
         extra = {}
 
-    log_at_level(message, extra=extra)
+    event_logger.log(log_level, message, extra=extra)
 
 
 def deets_from_url(url, resource_type, id):
@@ -41,12 +113,14 @@ def deets_from_url(url, resource_type, id):
         return resource_type, id
 
     # url: UPSTREAM_SERVER/fhir/ResourceType/<id or params>
-    parsed = urlparse(url)
-    if not parsed.path.startswith("/fhir/"):
+    start = url.find("/fhir/")
+    if start < 0:
         audit_entry(f"Unexpected fhir path: {url} can't parse", level="error")
-    items = parsed.path.split('/')
-    resource_type = resource_type or items[2]
-    id = id or items[3] if len(items) > 3 else None
+        return resource_type, id
+    path = url[start + len("/fhir/"):].partition("?")[0]
+    items = path.split("/", 2)
+    resource_type = resource_type or items[0]
+    id = id or (items[1] if len(items) > 1 else None)
     return resource_type, id
 
 
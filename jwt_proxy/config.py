@@ -17,6 +17,12 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
 LOGSERVER_TOKEN = os.getenv("LOGSERVER_TOKEN")
 LOGSERVER_URL = os.getenv("LOGSERVER_URL")
 UPSTREAM_SERVER = os.getenv("UPSTREAM_SERVER")
-PATH_WHITELIST = os.getenv(
-    "PATH_WHITELIST", "/hapi-fhir-jpaserver/fhir/metadata"
-).split(",")
+# seconds to wait connecting to, and between bytes read from, UPSTREAM_SERVER
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "60"))
+# exact paths proxied without a token; frozenset for hashed lookup
+PATH_WHITELIST = frozenset(
+    path.strip() for path in os.getenv(
+        "PATH_WHITELIST", "/hapi-fhir-jpaserver/fhir/metadata"
+    ).split(",") if path.strip()
+)
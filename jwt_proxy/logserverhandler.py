@@ -12,6 +12,8 @@ class LogServerHandler(logging.Handler):
         super().__init__()
         self.jwt = jwt
         self.url = f"{url}/events"
+        # reuse the log server connection across entries
+        self.session = requests.Session()
         self.setFormatter(
             JsonFormatter("%(asctime)s %(name)s %(levelname)s %(message)s")
         )
@@ -24,7 +26,7 @@ class LogServerHandler(logging.Handler):
             "Authorization": f"Bearer {self.jwt}",
         }
         try:
-            response = requests.post(
+            response = self.session.post(
                 url=self.url, headers=headers, json=log_entry, timeout=30
             )
             response.raise_for_status()
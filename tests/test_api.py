@@ -0,0 +1,109 @@
+from unittest import mock
+
+import pytest
+
+from jwt_proxy import api
+from jwt_proxy.app import create_app
+
+
+@pytest.fixture
+def app():
+    app = create_app(testing=True)
+    app.config.update(
+        SECRET_KEY="not-for-display",
+        OIDC_TOKEN_URI="https://keycloak.example.org/token",
+    )
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.mark.parametrize("path", ["/settings", "/fhir/.well-known/smart-configuration"])
+def test_etag_not_modified(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.get(path, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+@pytest.mark.parametrize("path", ["/settings", "/fhir/.well-known/smart-configuration"])
+def test_etag_mismatch(client, path):
+    response = client.get(path, headers={"If-None-Match": '"stale"'})
+    assert response.status_code == 200
+    assert response.json
+
+
+def test_smart_configuration(client):
+    response = client.get("/fhir/.well-known/smart-configuration")
+    assert response.json["token_endpoint"] == "https://keycloak.example.org/token"
+    assert response.cache_control.public
+    assert response.cache_control.max_age == 3600
+
+
+def test_settings_excludes_blacklist(client):
+    # repeat to cover both building and serving the cached body
+    for _ in range(2):
+        response = client.get("/settings")
+        assert response.status_code == 200
+        assert not [k for k in response.json if "SECRET" in k or "KEY" in k]
+        assert b"not-for-display" not in response.data
+
+
+def test_settings_key_blacklisted(client):
+    assert client.get("/settings/secret_key").status_code == 400
+
+
+def test_settings_path_whitelist_list(client):
+    response = client.get("/settings/path_whitelist")
+    assert isinstance(response.json["PATH_WHITELIST"], list)
+
+
+@pytest.mark.parametrize("upstream_server", [
+    "http://fhir.example.org", "http://fhir.example.org/"])
+def test_upstream_url_follows_config(app, upstream_server):
+    app.config["UPSTREAM_SERVER"] = upstream_server
+    with app.app_context():
+        assert api.upstream_url_for("fhir/Patient") == "http://fhir.example.org/fhir/Patient"
+
+
+def test_settings_excludes_derived_keys(client):
+    assert "UPSTREAM_SERVER_PREFIX" not in client.get("/settings").json
+
+
+@pytest.fixture
+def decode(monkeypatch):
+    """Accept any token; never proxy upstream"""
+    decode = mock.Mock(return_value={"email": "user@example.org"})
+    monkeypatch.setattr(api, "_decode_cached", decode)
+    monkeypatch.setattr(api, "proxy_request", mock.Mock(return_value="proxied"))
+    return decode
+
+
+@pytest.mark.parametrize("authorization", [None, "", "Basic dXNlcjpwYXNz", "Bearer", "Bearer  "])
+def test_token_missing(client, decode, authorization):
+    headers = {"Authorization": authorization} if authorization is not None else {}
+    response = client.get("/fhir/Patient", headers=headers)
+    assert response.status_code == 400
+    assert response.json["message"] == "token missing"
+    decode.assert_not_called()
+
+
+@pytest.mark.parametrize("scheme", ["Bearer", "bearer", "BEARER"])
+def test_bearer_scheme_case_insensitive(client, decode, scheme):
+    response = client.get("/fhir/Patient", headers={"Authorization": f"{scheme} token"})
+    assert response.status_code == 200
+    assert decode.call_args[0][0] == "token"
+
+
+def test_token_too_large(client, decode):
+    token = "x" * (api.MAX_JWT_LEN + 1)
+    response = client.get("/fhir/Patient", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 400
+    assert response.json["message"] == "token too large"
+    decode.assert_not_called()
@@ -0,0 +1,100 @@
+import logging
+import queue
+import time
+from unittest import mock
+
+import pytest
+
+from jwt_proxy import audit
+from jwt_proxy.audit import AuditQueueListener, DropOldestQueueHandler
+
+
+def record(msg):
+    return logging.makeLogRecord({"msg": msg})
+
+
+def test_drop_oldest_when_full():
+    log_queue = queue.Queue(maxsize=2)
+    handler = DropOldestQueueHandler(log_queue)
+    for msg in ("one", "two", "three", "four"):
+        handler.enqueue(record(msg))
+
+    assert handler.dropped == 2
+    assert [log_queue.get_nowait().msg for _ in range(2)] == ["three", "four"]
+
+
+def test_drop_oldest_retries_when_drained_concurrently():
+    log_queue = queue.Queue(maxsize=1)
+    log_queue.put_nowait(record("one"))
+    handler = DropOldestQueueHandler(log_queue)
+
+    # another consumer empties the queue between the failed put and the get
+    put_nowait = log_queue.put_nowait
+
+    def racing_put_nowait(item):
+        if log_queue.full():
+            log_queue.get_nowait()
+            raise queue.Full
+        put_nowait(item)
+
+    log_queue.put_nowait = racing_put_nowait
+    handler.enqueue(record("two"))
+
+    assert handler.dropped == 0
+    assert log_queue.get_nowait().msg == "two"
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self, delay=0):
+        super().__init__()
+        self.delay = delay
+        self.messages = []
+
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.messages.append(record.msg)
+
+
+def test_listener_stop_drains_queue():
+    log_queue = queue.Queue(maxsize=2)
+    handler = RecordingHandler()
+    listener = AuditQueueListener(log_queue, handler)
+    for msg in ("one", "two"):
+        log_queue.put_nowait(record(msg))
+    listener.start()
+    listener.stop(timeout=5)
+
+    assert handler.messages == ["one", "two"]
+
+
+def test_listener_stop_bounded():
+    log_queue = queue.Queue(maxsize=2)
+    handler = RecordingHandler(delay=0.5)
+    listener = AuditQueueListener(log_queue, handler)
+    log_queue.put_nowait(record("one"))
+    listener.start()
+    # fill the queue while the listener is busy emitting "one"
+    for msg in ("two", "three"):
+        log_queue.put(record(msg), timeout=1)
+
+    started = time.monotonic()
+    listener.stop(timeout=0.2)
+    assert time.monotonic() - started < 0.5
+    assert listener._thread is None
+    # remaining entries are abandoned, not posted
+    assert "three" not in handler.messages
+
+
+@pytest.mark.parametrize("level, expected", [
+    ("info", logging.INFO), ("INFO", logging.INFO), ("Warning", logging.WARNING)])
+def test_audit_entry_level_names(monkeypatch, level, expected):
+    log = mock.Mock()
+    monkeypatch.setattr(audit.event_logger, "log", log)
+    audit.audit_entry("message", level=level)
+    assert log.call_args[0][0] == expected
+
+
+@pytest.mark.parametrize("level", ["verbose", logging.INFO, None])
+def test_audit_entry_bogus_level(level):
+    with pytest.raises(ValueError, match="audit_entry given bogus level"):
+        audit.audit_entry("message", level=level)
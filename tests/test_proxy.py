@@ -0,0 +1,159 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+from unittest import mock
+
+import pytest
+from requests.structures import CaseInsensitiveDict
+
+from jwt_proxy import api
+from jwt_proxy.app import create_app
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """Sets a session cookie on /login, echoes the Cookie header otherwise"""
+
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(1)
+        body = (self.headers.get("Cookie") or "").encode("utf-8")
+        self.send_response(200)
+        if self.path == "/login":
+            self.send_header("Set-Cookie", "JSESSIONID=user-a-session; Path=/")
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), UpstreamHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(upstream):
+    app = create_app(testing=True)
+    app.config.update(
+        UPSTREAM_SERVER=upstream,
+        PATH_WHITELIST=frozenset(("/login", "/other", "/slow")),
+    )
+    return app.test_client()
+
+
+def test_upstream_cookies_not_shared(client):
+    client.get("/login")
+    client.cookie_jar.clear()
+
+    response = client.get("/other")
+    assert response.status_code == 200
+    assert response.data == b""
+
+
+def test_client_cookie_forwarded(client):
+    client.set_cookie("localhost", "mine", "1")
+    response = client.get("/other")
+    assert response.data == b"mine=1"
+
+
+def test_stalled_upstream_times_out(client):
+    client.application.config["UPSTREAM_READ_TIMEOUT"] = 0.1
+    started = time.monotonic()
+    response = client.get("/slow")
+    assert response.status_code == 504
+    assert time.monotonic() - started < 1
+
+
+@pytest.fixture
+def upstream_response():
+    """Fake streamed upstream response, returned by the mocked session"""
+    response = mock.Mock()
+    response.status_code = 201
+    response.headers = CaseInsensitiveDict({
+        "Content-Type": "application/fhir+json",
+        "Content-Length": "13",
+        "Keep-Alive": "timeout=5",
+        "Connection": "keep-alive",
+        "ETag": 'W/"1"',
+    })
+    response.iter_content.return_value = iter((b'{"id":', b' "1"}\n'))
+    return response
+
+
+@pytest.fixture
+def mocked_client(monkeypatch, upstream_response):
+    monkeypatch.setattr(
+        api._UPSTREAM_SESSION, "request", mock.Mock(return_value=upstream_response))
+    app = create_app(testing=True)
+    app.config.update(
+        UPSTREAM_SERVER="http://fhir.example.org",
+        PATH_WHITELIST=frozenset(("/Patient",)),
+    )
+    return app.test_client()
+
+
+@pytest.fixture
+def audit(monkeypatch):
+    audit = mock.Mock()
+    monkeypatch.setattr(api, "audit_HAPI_change", audit)
+    return audit
+
+
+def test_streams_body_and_status(mocked_client, audit):
+    response = mocked_client.get("/Patient")
+    assert response.status_code == 201
+    assert response.data == b'{"id": "1"}\n'
+    assert response.headers["ETag"] == 'W/"1"'
+    kwargs = api._UPSTREAM_SESSION.request.call_args[1]
+    assert kwargs["stream"] is True
+    assert kwargs["url"] == "http://fhir.example.org/Patient"
+
+
+def test_excluded_request_headers(mocked_client, audit):
+    mocked_client.get("/Patient", headers={
+        "Connection": "keep-alive",
+        "Keep-Alive": "timeout=5",
+        "Proxy-Authorization": "Basic c2VjcmV0",
+        "Accept": "application/fhir+json",
+    })
+    forwarded = {
+        k.lower() for k in api._UPSTREAM_SESSION.request.call_args[1]["headers"]}
+    assert "accept" in forwarded
+    assert not forwarded & api.EXCLUDED_HEADERS
+
+
+def test_excluded_response_headers(mocked_client, audit):
+    response = mocked_client.get("/Patient")
+    returned = {k.lower() for k in response.headers.keys()}
+    assert "etag" in returned
+    assert not returned & (api.HOP_BY_HOP_HEADERS | {"content-encoding"})
+    # recomputed for the re-chunked body, not copied from upstream
+    assert response.headers.get("Content-Length") != "13"
+
+
+def test_upstream_response_closed(mocked_client, upstream_response, audit):
+    response = mocked_client.get("/Patient")
+    upstream_response.close.assert_not_called()
+    response.close()
+    upstream_response.close.assert_called_once()
+
+
+def test_json_change_audited(mocked_client, audit):
+    mocked_client.post("/Patient", json={"resourceType": "Patient"})
+    audit.assert_called_once()
+    assert audit.call_args[1]["method"] == "POST"
+    assert audit.call_args[1]["url"] == "http://fhir.example.org/Patient"
+
+
+def test_non_json_change_not_audited(mocked_client, upstream_response, audit):
+    upstream_response.headers["Content-Type"] = "text/plain"
+    mocked_client.post("/Patient", data="hello")
+    audit.assert_not_called()
@@ -0,0 +1,118 @@
+import time
+from unittest import mock
+
+from cachetools import TLRUCache
+import jwt
+import pytest
+
+from jwt_proxy import api
+
+JWKS_URL = "https://keycloak.example.org/certs"
+
+
+@pytest.fixture(autouse=True)
+def jwks_client(monkeypatch):
+    """Fake JWKS client; no network, empty token cache per test"""
+    api._TOKEN_CACHE.clear()
+    api._clear_jwks_cache()
+    client = mock.Mock(spec=jwt.PyJWKClient)
+    client.get_signing_key_from_jwt.return_value.key = "signing-key"
+    monkeypatch.setattr(api, "_get_jwks_client", lambda url: client)
+    yield client
+    api._TOKEN_CACHE.clear()
+
+
+def test_token_cache_hit():
+    claims = {"email": "user@example.org", "exp": time.time() + 300}
+    with mock.patch("jwt_proxy.api.jwt.decode", return_value=claims) as decode:
+        assert api._decode_cached("token", JWKS_URL) == claims
+        assert api._decode_cached("token", JWKS_URL) == claims
+    decode.assert_called_once()
+
+
+def test_distinct_tokens_not_shared():
+    with mock.patch(
+        "jwt_proxy.api.jwt.decode",
+        side_effect=[{"email": "a@example.org"}, {"email": "b@example.org"}],
+    ) as decode:
+        assert api._decode_cached("token-a", JWKS_URL)["email"] == "a@example.org"
+        assert api._decode_cached("token-b", JWKS_URL)["email"] == "b@example.org"
+    assert decode.call_count == 2
+
+
+def test_token_cache_expires_at_exp(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(api, "_TOKEN_CACHE", TLRUCache(
+        maxsize=10, ttu=api._token_ttu, timer=lambda: now[0]))
+    claims = {"email": "user@example.org", "exp": now[0] + 5}
+    with mock.patch("jwt_proxy.api.jwt.decode", return_value=claims) as decode:
+        api._decode_cached("token", JWKS_URL)
+        now[0] += 4.9
+        api._decode_cached("token", JWKS_URL)
+        assert decode.call_count == 1
+
+        # expires at exp, before TOKEN_CACHE_TTL
+        now[0] += 0.1
+        api._decode_cached("token", JWKS_URL)
+    assert decode.call_count == 2
+
+
+def test_expired_token_not_cached():
+    claims = {"email": "user@example.org", "exp": time.time() - 1}
+    with mock.patch("jwt_proxy.api.jwt.decode", return_value=claims) as decode:
+        api._decode_cached("token", JWKS_URL)
+        api._decode_cached("token", JWKS_URL)
+    assert decode.call_count == 2
+
+
+@pytest.mark.parametrize("error", [
+    jwt.exceptions.InvalidSignatureError,
+    jwt.exceptions.ExpiredSignatureError,
+    jwt.exceptions.InvalidAudienceError,
+])
+def test_failed_verification_not_cached(error):
+    with mock.patch("jwt_proxy.api.jwt.decode", side_effect=error) as decode:
+        for _ in range(2):
+            with pytest.raises(error):
+                api._decode_cached("token", JWKS_URL)
+    assert decode.call_count == 2
+    assert len(api._TOKEN_CACHE) == 0
+
+
+def test_invalid_signature_evicts_jwks_client(monkeypatch):
+    # eviction acts on the client cache itself, not the faked _get_jwks_client
+    monkeypatch.setitem(api._JWKS_CLIENTS, JWKS_URL, mock.Mock(spec=jwt.PyJWKClient))
+    with mock.patch(
+        "jwt_proxy.api.jwt.decode",
+        side_effect=jwt.exceptions.InvalidSignatureError,
+    ):
+        with pytest.raises(jwt.exceptions.InvalidSignatureError):
+            api._decode_cached("token", JWKS_URL)
+    assert JWKS_URL not in api._JWKS_CLIENTS
+
+
+def test_jwks_eviction_throttled(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(api, "time", mock.Mock(monotonic=lambda: now[0]))
+    api._JWKS_CLIENTS[JWKS_URL] = first = mock.Mock(spec=jwt.PyJWKClient)
+
+    assert api._evict_jwks_client(JWKS_URL)
+    assert JWKS_URL not in api._JWKS_CLIENTS
+
+    # further failures within the interval keep the refetched client
+    api._JWKS_CLIENTS[JWKS_URL] = second = mock.Mock(spec=jwt.PyJWKClient)
+    now[0] += api.JWKS_EVICT_INTERVAL - 1
+    assert not api._evict_jwks_client(JWKS_URL)
+    assert api._JWKS_CLIENTS[JWKS_URL] is second
+
+    now[0] += 1
+    assert api._evict_jwks_client(JWKS_URL)
+    assert JWKS_URL not in api._JWKS_CLIENTS
+    assert first is not second
+
+
+def test_jwks_eviction_throttled_per_url(monkeypatch):
+    monkeypatch.setattr(api, "time", mock.Mock(monotonic=lambda: 1000.0))
+    assert api._evict_jwks_client(JWKS_URL)
+    assert api._evict_jwks_client("https://other.example.org/certs")
+    assert not api._evict_jwks_client(JWKS_URL)